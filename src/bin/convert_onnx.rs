@@ -4,7 +4,7 @@ use std::collections::HashMap;
 
 fn main() -> Result<()> {
     let path = "/Users/javoerokour/Desktop/BUDDHA/CODE/agency/rust_agency/artifacts/chatterbox/conditional_decoder_q8_full.onnx";
-    let model = candle_onnx::read_file(path)?;
+    let model = rust_agency::models::onnx_loader::load_model(path)?;
     let device = Device::Cpu;
 
     let mut inputs = HashMap::new();
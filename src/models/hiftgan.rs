@@ -134,7 +134,7 @@ impl HiFTGAN {
             if let (Ok(s), Ok(z)) = (finder.remove("spk_embed_affine_layer.scales"), finder.remove("spk_embed_affine_layer.zp")) {
                 UnifiedLinear::load_quantized(w, s, z, b, 80, 192, device)?
             } else {
-                UnifiedLinear::new(UnifiedWeight::F32(w), b)
+                UnifiedLinear::new(UnifiedWeight::Dense(w), b)
             }
         };
 
@@ -2,7 +2,8 @@ pub mod t3;
 pub mod t3_candle;
 pub mod quantized;
 pub mod hiftgan;
+pub mod onnx_loader;
 pub mod reasoner;
 pub use t3::{T3Model, Config as T3Config};
-pub use t3_candle::T3Candle;
+pub use t3_candle::{T3Candle, LayerKv, SamplingConfig};
 pub use reasoner::{ReasonerModel, Config as ReasonerConfig};
\ No newline at end of file
@@ -0,0 +1,184 @@
+//! ONNX model loading with memory-mapped weights.
+//!
+//! `candle_onnx::read_file` reads the whole graph into a heap buffer and then decodes it,
+//! so a multi-100MB model is held twice during load. Here the `.onnx` file is mmap'd and
+//! decoded straight from the page cache. Tensors saved with ONNX external data
+//! (`save_as_external_data=True`) are resolved from their sidecar file, also via mmap,
+//! which keeps large FP32 graphs under the 2 GB protobuf limit.
+
+use anyhow::{Context, Result};
+use candle_onnx::onnx::{tensor_proto::DataLocation, GraphProto, ModelProto, TensorProto};
+use memmap2::Mmap;
+use prost_onnx::Message;
+use std::collections::HashMap;
+use std::fs::File;
+use std::path::{Path, PathBuf};
+
+fn map_file(path: &Path) -> Result<Mmap> {
+    let file = File::open(path).with_context(|| format!("opening {}", path.display()))?;
+    // Model files are treated as read-only artifacts for the lifetime of the map
+    Ok(unsafe { Mmap::map(&file)? })
+}
+
+/// Loads an ONNX model, inlining any external-data tensors so the result can be passed
+/// directly to `candle_onnx::simple_eval`.
+pub fn load_model(path: impl AsRef<Path>) -> Result<ModelProto> {
+    let path = path.as_ref();
+    let mmap = map_file(path)?;
+    let mut model = ModelProto::decode(&mmap[..])
+        .with_context(|| format!("decoding ONNX model {}", path.display()))?;
+    drop(mmap);
+
+    let base_dir = path.parent().map(Path::to_path_buf).unwrap_or_default();
+    if let Some(graph) = model.graph.as_mut() {
+        let mut sidecars: HashMap<PathBuf, Mmap> = HashMap::new();
+        resolve_graph(graph, &base_dir, &mut sidecars)?;
+    }
+    Ok(model)
+}
+
+/// Inlines external data for initializers and for tensors held in node attributes
+/// (`Constant` values), recursing into control-flow subgraphs.
+fn resolve_graph(graph: &mut GraphProto, base_dir: &Path, sidecars: &mut HashMap<PathBuf, Mmap>) -> Result<()> {
+    for tensor in graph.initializer.iter_mut() {
+        resolve_tensor(tensor, base_dir, sidecars)?;
+    }
+    for node in graph.node.iter_mut() {
+        for attr in node.attribute.iter_mut() {
+            if let Some(tensor) = attr.t.as_mut() {
+                resolve_tensor(tensor, base_dir, sidecars)?;
+            }
+            for tensor in attr.tensors.iter_mut() {
+                resolve_tensor(tensor, base_dir, sidecars)?;
+            }
+            if let Some(subgraph) = attr.g.as_mut() {
+                resolve_graph(subgraph, base_dir, sidecars)?;
+            }
+            for subgraph in attr.graphs.iter_mut() {
+                resolve_graph(subgraph, base_dir, sidecars)?;
+            }
+        }
+    }
+    Ok(())
+}
+
+fn resolve_tensor(tensor: &mut TensorProto, base_dir: &Path, sidecars: &mut HashMap<PathBuf, Mmap>) -> Result<()> {
+    if tensor.data_location != DataLocation::External as i32 {
+        return Ok(());
+    }
+    let mut location = None;
+    let mut offset = 0usize;
+    let mut length = None;
+    for entry in &tensor.external_data {
+        match entry.key.as_str() {
+            "location" => location = Some(entry.value.clone()),
+            "offset" => offset = entry.value.parse()?,
+            "length" => length = Some(entry.value.parse::<usize>()?),
+            _ => {}
+        }
+    }
+    let location = location
+        .ok_or_else(|| anyhow::anyhow!("Tensor '{}' has external data without a location", tensor.name))?;
+
+    let sidecar_path = base_dir.join(&location);
+    if !sidecars.contains_key(&sidecar_path) {
+        let mmap = map_file(&sidecar_path)?;
+        sidecars.insert(sidecar_path.clone(), mmap);
+    }
+    let data = &sidecars[&sidecar_path];
+
+    let end = match length {
+        Some(len) => offset.checked_add(len),
+        None => Some(data.len()),
+    };
+    let end = match end {
+        Some(end) if offset <= end && end <= data.len() => end,
+        _ => anyhow::bail!("Tensor '{}' reads past the end of {}", tensor.name, location),
+    };
+
+    tensor.raw_data = data[offset..end].to_vec();
+    tensor.data_location = DataLocation::Default as i32;
+    tensor.external_data.clear();
+    Ok(())
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use candle_onnx::onnx::{AttributeProto, NodeProto, StringStringEntryProto};
+
+    fn external(name: &str, location: &str, offset: usize, length: Option<usize>) -> TensorProto {
+        let mut external_data = vec![
+            StringStringEntryProto { key: "location".to_string(), value: location.to_string() },
+            StringStringEntryProto { key: "offset".to_string(), value: offset.to_string() },
+        ];
+        if let Some(len) = length {
+            external_data.push(StringStringEntryProto { key: "length".to_string(), value: len.to_string() });
+        }
+        TensorProto {
+            name: name.to_string(),
+            dims: vec![2],
+            data_type: 1, // FLOAT
+            data_location: DataLocation::External as i32,
+            external_data,
+            ..Default::default()
+        }
+    }
+
+    fn write_model(dir: &Path, graph: GraphProto) -> PathBuf {
+        let model = ModelProto { graph: Some(graph), ..Default::default() };
+        let path = dir.join("model.onnx");
+        std::fs::write(&path, model.encode_to_vec()).unwrap();
+        path
+    }
+
+    #[test]
+    fn test_load_model_inlines_external_data() {
+        let dir = tempfile::tempdir().unwrap();
+        let mut sidecar = vec![0xAAu8; 4];
+        let weights: Vec<u8> = [1.5f32, -2.0f32].iter().flat_map(|v| v.to_le_bytes()).collect();
+        sidecar.extend_from_slice(&weights);
+        std::fs::write(dir.path().join("model.weights"), &sidecar).unwrap();
+
+        let constant = NodeProto {
+            op_type: "Constant".to_string(),
+            attribute: vec![AttributeProto {
+                name: "value".to_string(),
+                t: Some(external("c", "model.weights", 4, None)),
+                ..Default::default()
+            }],
+            ..Default::default()
+        };
+        let graph = GraphProto {
+            initializer: vec![external("w", "model.weights", 4, Some(8))],
+            node: vec![constant],
+            ..Default::default()
+        };
+        let model = load_model(write_model(dir.path(), graph)).unwrap();
+        let graph = model.graph.unwrap();
+
+        let w = &graph.initializer[0];
+        assert_eq!(w.raw_data, weights);
+        assert_eq!(w.data_location, DataLocation::Default as i32);
+        assert!(w.external_data.is_empty());
+
+        let c = graph.node[0].attribute[0].t.as_ref().unwrap();
+        assert_eq!(c.raw_data, weights);
+        assert_eq!(c.data_location, DataLocation::Default as i32);
+    }
+
+    #[test]
+    fn test_load_model_rejects_out_of_range_external_data() {
+        let dir = tempfile::tempdir().unwrap();
+        std::fs::write(dir.path().join("model.weights"), [0u8; 8]).unwrap();
+
+        for tensor in [
+            external("w", "model.weights", 16, None),
+            external("w", "model.weights", 4, Some(8)),
+            external("w", "model.weights", 4, Some(usize::MAX)),
+        ] {
+            let graph = GraphProto { initializer: vec![tensor], ..Default::default() };
+            assert!(load_model(write_model(dir.path(), graph)).is_err());
+        }
+    }
+}
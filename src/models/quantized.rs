@@ -3,7 +3,8 @@ use candle_core::quantized::{QTensor, QStorage, QMatMul, GgmlDType};
 
 #[derive(Debug, Clone)]
 pub enum UnifiedWeight {
-    F32(Tensor),
+    /// Unquantized weight in any float dtype (F32 at load, possibly cast by `to_compute_dtype`)
+    Dense(Tensor),
     Q8 {
         weight: Tensor,
         scales: Tensor,
@@ -25,7 +26,7 @@ pub enum UnifiedWeight {
 impl UnifiedWeight {
     pub fn dequantize(&self, device: &Device) -> Result<Tensor> {
         match self {
-            UnifiedWeight::F32(t) => t.to_device(device),
+            UnifiedWeight::Dense(t) => t.to_device(device),
             UnifiedWeight::Q8 { dequantized, .. } => {
                 dequantized.as_ref().cloned().ok_or_else(|| candle_core::Error::Msg("Q8 dequant not cached".to_string()))
             },
@@ -37,7 +38,7 @@ impl UnifiedWeight {
     }
 }
 
-#[derive(Debug)]
+#[derive(Debug, Clone)]
 pub struct UnifiedLinear {
     pub weight: UnifiedWeight,
     pub bias: Option<Tensor>,
@@ -69,6 +70,23 @@ impl UnifiedLinear {
         Ok(Self::new(uw, bias))
     }
 
+    /// Keeps GGML Q8_0 blocks (32 int8 values + one f16 scale) packed as a `QMatMul`, so
+    /// matmuls run on Candle's int8 kernels and stream a quarter of the F32 weight bytes.
+    /// Note the kernels quantize the activations too, so results are close to but not
+    /// identical with a matmul against the dequantized weight.
+    /// Data in any other layout falls back to `load_q8_simple`.
+    pub fn load_q8_0(data: Tensor, bias: Option<Tensor>, n: usize, k: usize, device: &Device) -> Result<Self> {
+        let expected_size = (n * k / 32) * 34;
+        if k % 32 != 0 || data.elem_count() != expected_size {
+            return Self::load_q8_simple(data, bias, n, k, device);
+        }
+        let data_vec = data.flatten_all()?.to_vec1::<u8>()?;
+        let storage = QStorage::from_data(std::borrow::Cow::Owned(data_vec), device, GgmlDType::Q8_0)?;
+        let qtensor = QTensor::new(storage, Shape::from((n, k)))?;
+        let qmatmul = QMatMul::from_qtensor(qtensor)?;
+        Ok(Self::new(UnifiedWeight::Q8_0(qmatmul), bias))
+    }
+
     pub fn load_q8_simple(data: Tensor, bias: Option<Tensor>, n: usize, k: usize, device: &Device) -> Result<Self> {
         // Check if it matches GGML Q8_0 size (34 bytes per 32 elements)
         let expected_size = (n * k / 32) * 34;
@@ -95,43 +113,65 @@ impl UnifiedLinear {
         Ok(Self::new(uw, bias))
     }
 
+    /// Casts the dense weight (or its cached dequantization) to `dtype`. Activations are cast
+    /// to the weight dtype at matmul time, so F16/BF16 halves the weight bytes streamed per
+    /// decode step. Packed Q8_0 kernels are left untouched.
+    pub fn to_compute_dtype(&mut self, dtype: DType) -> Result<()> {
+        match &mut self.weight {
+            UnifiedWeight::Dense(w) => *w = w.to_dtype(dtype)?,
+            UnifiedWeight::Q8 { dequantized, .. } | UnifiedWeight::Q8Simple { dequantized, .. } => {
+                if let Some(w_deq) = dequantized {
+                    *w_deq = w_deq.to_dtype(dtype)?;
+                }
+            }
+            UnifiedWeight::Q8_0(_) => {}
+        }
+        Ok(())
+    }
+
+    /// Dtype the matmul runs in, or `None` for packed Q8_0 kernels, which ignore
+    /// `to_compute_dtype`.
+    pub fn compute_dtype(&self) -> Option<DType> {
+        match &self.weight {
+            UnifiedWeight::Dense(w) => Some(w.dtype()),
+            UnifiedWeight::Q8 { dequantized, .. } | UnifiedWeight::Q8Simple { dequantized, .. } => {
+                dequantized.as_ref().map(|w| w.dtype())
+            }
+            UnifiedWeight::Q8_0(_) => None,
+        }
+    }
+
+    /// `x @ w.T` computed in the weight's dtype, flattening rank-3 inputs to a single GEMM.
+    /// `w.t()` is a stride view; the GEMM backends consume a transposed RHS without a copy.
+    fn matmul_t(x: &Tensor, w: &Tensor) -> Result<Tensor> {
+        let w_t = w.t()?;
+        let w_dtype = w.dtype();
+        let x_cast = if x.dtype() != w_dtype { x.to_dtype(w_dtype)? } else { x.clone() };
+        match x_cast.rank() {
+            3 => {
+                let (b, s, _) = x_cast.dims3()?;
+                let res = x_cast.reshape((b * s, w.dim(1)?))?.matmul(&w_t)?;
+                res.reshape((b, s, w.dim(0)?))
+            },
+            _ => x_cast.matmul(&w_t)
+        }
+    }
+
     pub fn forward(&self, x: &Tensor) -> Result<Tensor> {
         let x_dtype = x.dtype();
         let out = match &self.weight {
-            UnifiedWeight::F32(w) => x.matmul(&w.t()?.to_dtype(x_dtype)?)?,
+            UnifiedWeight::Dense(w) => Self::matmul_t(x, w)?.to_dtype(x_dtype)?,
             UnifiedWeight::Q8_0(q) => q.forward(x)?,
             UnifiedWeight::Q8 { dequantized, .. } => {
                 if let Some(w_deq) = dequantized {
-                    let w_t = w_deq.t()?;
-                    let w_dtype = w_deq.dtype();
-                    let x_cast = if x_dtype != w_dtype { x.to_dtype(w_dtype)? } else { x.clone() };
-                    
-                    match x_cast.rank() {
-                        3 => {
-                            let (b, s, _) = x_cast.dims3()?;
-                            let res = x_cast.reshape((b * s, w_deq.dim(1)?))?.matmul(&w_t)?;
-                            res.reshape((b, s, w_deq.dim(0)?))?
-                        },
-                        _ => x_cast.matmul(&w_t)?
-                    }.to_dtype(DType::F32)?
+                    Self::matmul_t(x, w_deq)?.to_dtype(DType::F32)?
                 } else {
                     bail!("Uncached dequantization not supported for performance");
                 }
             },
             UnifiedWeight::Q8Simple { dequantized, .. } => {
                 if let Some(w_deq) = dequantized {
-                    let w_t = w_deq.t()?;
-                    let w_dtype = w_deq.dtype();
-                    let x_cast = if x_dtype != w_dtype { x.to_dtype(w_dtype)? } else { x.clone() };
-                    
-                    match x_cast.rank() {
-                        3 => {
-                            let (b, s, _) = x_cast.dims3()?;
-                            let res = x_cast.reshape((b * s, w_deq.dim(1)?))?.matmul(&w_t)?;
-                            res.reshape((b, s, w_deq.dim(0)?))?
-                        },
-                        _ => x_cast.matmul(&w_t)?
-                    }.to_dtype(DType::F32)?
+                    Self::matmul_t(x, w_deq)?.to_dtype(DType::F32)?
                 } else {
                     bail!("Uncached simple dequantization not supported for performance");
                 }
@@ -1,4 +1,4 @@
-use candle_core::{Result, Tensor, D};
+use candle_core::{DType, Device, Result, Tensor, D};
 use candle_nn::{embedding, Embedding, LayerNorm, Linear, Module, VarBuilder};
 
 #[derive(Debug, Clone)]
@@ -71,14 +71,13 @@ impl Attention {
         }
         self.kv_cache = Some((k.clone(), v.clone()));
 
-        let _k_len = k.dim(D::Minus2)?;
-        let mut att = (q.matmul(&k.transpose(D::Minus2, D::Minus1)?)? / (self.head_dim as f64).sqrt())?;
+        let q = (q * (1.0 / (self.head_dim as f64).sqrt()))?;
+        let mut att = q.matmul(&k.transpose(D::Minus2, D::Minus1)?.contiguous()?)?;
         if let Some(mask) = mask {
-            let mask = mask.broadcast_as(att.shape())?;
-            let neg_inf = Tensor::new(f32::NEG_INFINITY, att.device())?.broadcast_as(att.shape())?;
-            att = mask.where_cond(&att, &neg_inf)?;
+            // Additive mask: 0 keeps a score, -inf removes it
+            att = att.broadcast_add(mask)?;
         }
-        att = candle_nn::ops::softmax(&att, D::Minus1)?;
+        att = candle_nn::ops::softmax_last_dim(&att)?;
         let y = att.matmul(&v)?;
         let y = y.transpose(1, 2)?.reshape((b_sz, seq_len, n_embd))?;
         self.c_proj.forward(&y)
@@ -167,24 +166,8 @@ impl T3Model {
     }
 
     pub fn forward(&mut self, input_ids: &Tensor, position_ids: &Tensor) -> Result<Tensor> {
-        let (_b_sz, seq_len) = input_ids.dims2()?;
         let input_embeds = self.wte.forward(input_ids)?;
-        let position_embeds = self.wpe.forward(position_ids)?;
-        let mut x = (input_embeds + position_embeds)?;
-        
-        let mask = if seq_len > 1 {
-            let mask: Vec<_> = (0..seq_len)
-                .flat_map(|i| (0..seq_len).map(move |j| u8::from(j <= i)))
-                .collect();
-            Some(Tensor::from_slice(&mask, (seq_len, seq_len), x.device())?)
-        } else {
-            None
-        };
-
-        for block in self.h.iter_mut() {
-            x = block.forward(&x, mask.as_ref())?;
-        }
-        self.ln_f.forward(&x)
+        self.forward_embeds(&input_embeds, position_ids)
     }
 
     pub fn forward_embeds(&mut self, embeds: &Tensor, position_ids: &Tensor) -> Result<Tensor> {
@@ -192,15 +175,8 @@ impl T3Model {
         let position_embeds = self.wpe.forward(position_ids)?;
         let mut x = (embeds + position_embeds)?;
         
-        // Causal mask for the input sequence
-        let mask = if seq_len > 1 {
-            let mask: Vec<_> = (0..seq_len)
-                .flat_map(|i| (0..seq_len).map(move |j| u8::from(j <= i)))
-                .collect();
-            Some(Tensor::from_slice(&mask, (seq_len, seq_len), x.device())?)
-        } else {
-            None
-        };
+        // Causal mask for the input sequence, shared by every layer
+        let mask = self.causal_mask(seq_len, x.dtype(), x.device())?;
 
         for block in self.h.iter_mut() {
             x = block.forward(&x, mask.as_ref())?;
@@ -208,6 +184,24 @@ impl T3Model {
         self.ln_f.forward(&x)
     }
 
+    /// Additive causal mask of shape `(seq_len, past_len + seq_len)`, offset by the cached
+    /// length so multi-token steps on top of the KV cache stay causal. Built once per forward
+    /// instead of broadcasting a boolean mask and a -inf fill in every layer.
+    fn causal_mask(&self, seq_len: usize, dtype: DType, device: &Device) -> Result<Option<Tensor>> {
+        if seq_len <= 1 {
+            return Ok(None);
+        }
+        let past_len = match self.h.first().and_then(|block| block.attn.kv_cache.as_ref()) {
+            Some((k, _)) => k.dim(2)?,
+            None => 0,
+        };
+        let kv_len = past_len + seq_len;
+        let mask: Vec<f32> = (0..seq_len)
+            .flat_map(|i| (0..kv_len).map(move |j| if j <= i + past_len { 0.0 } else { f32::NEG_INFINITY }))
+            .collect();
+        Ok(Some(Tensor::from_slice(&mask, (seq_len, kv_len), device)?.to_dtype(dtype)?))
+    }
+
     pub fn clear_cache(&mut self) {
         for block in self.h.iter_mut() {
             block.clear_cache();
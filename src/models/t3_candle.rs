@@ -5,6 +5,14 @@ use crate::models::quantized::{UnifiedLinear, UnifiedWeight};
 use std::collections::HashMap;
 use tokenizers::Tokenizer;
 
+/// Upper bound on speech tokens produced per utterance.
+const MAX_SPEECH_TOKENS: usize = 1024;
+/// Width of the speech head: 6561 voice tokens plus the start/stop meta-tokens.
+const SPEECH_VOCAB_SIZE: usize = 6563;
+/// Decode steps between host-side stop checks on GPU backends, where each readback waits
+/// for the device queue. On CPU a readback is a plain copy, so stops are checked every step.
+const SYNC_INTERVAL: usize = 8;
+
 fn get_tensor(weights: &HashMap<String, Tensor>, name: &str) -> Result<Tensor> {
     weights.get(name).cloned().ok_or_else(|| candle_core::Error::Msg(format!("Weight {} not found", name)))
 }
@@ -36,8 +44,26 @@ fn load_linear(weights: &HashMap<String, Tensor>, prefix: &str, _in_dim: usize,
     } else {
         let weight_name = format!("{}.weight", prefix);
         let w = get_tensor(weights, &weight_name)?;
-        Ok(UnifiedLinear::new(UnifiedWeight::F32(w), bias))
+        Ok(UnifiedLinear::new(UnifiedWeight::Dense(w), bias))
+    }
+}
+
+/// Loads a GEMM projection. By default this is `load_linear` (a dequantized dense copy);
+/// with `AGENCY_T3_Q8_KERNELS=1`, GGML Q8_0 weights instead stay packed for candle's int8
+/// matmul kernels. Those kernels also quantize the activations (q8_0/q8_1 on CPU and CUDA),
+/// so the packed path trades exact parity with the dequantized one for bandwidth.
+fn load_projection(weights: &HashMap<String, Tensor>, prefix: &str, in_dim: usize, out_dim: usize, device: &Device) -> Result<UnifiedLinear> {
+    let qshape_name = format!("{}.weight.qshape", prefix);
+    let qscales_name = format!("{}.weight.qscales", prefix);
+    let packed_kernels = std::env::var("AGENCY_T3_Q8_KERNELS").map(|v| v == "1").unwrap_or(false);
+
+    if packed_kernels && weights.contains_key(&qshape_name) && !weights.contains_key(&qscales_name) {
+        let qshape = get_tensor(weights, &qshape_name)?.to_vec1::<u32>()?;
+        let data = get_tensor(weights, &format!("{}.weight.qdata", prefix))?;
+        let bias = weights.get(&format!("{}.bias", prefix)).cloned();
+        return UnifiedLinear::load_q8_0(data, bias, qshape[0] as usize, qshape[1] as usize, device);
     }
+    load_linear(weights, prefix, in_dim, out_dim, device)
 }
 
 pub fn load_embedding(weights: &HashMap<String, Tensor>, prefix: &str, _vocab_size: usize, n_embd: usize, device: &Device) -> Result<Embedding> {
@@ -63,29 +89,178 @@ fn vocab_size_fix(weights: &HashMap<String, Tensor>, qshape_name: &str) -> Resul
 fn sanitize(t: &Tensor) -> Result<Tensor> {
     // SOTA 6.5: Precise per-element sanitization. 
     // We replace only the corrupted elements with 0.0, preserving the rest of the signal.
-    let mask_nan = t.ne(t)?.to_dtype(DType::U8)?; // NaN != NaN is true
-    let mask_inf = t.abs()?.gt(1e30f32)?.to_dtype(DType::U8)?; 
-    let mask_u8 = (mask_nan + mask_inf)?; // Combine masks (any value > 0 means corrupted)
-    
-    // Check if any element needs sanitization
-    let corruption_count = mask_u8.sum_all()?.to_scalar::<u8>()?;
-    if corruption_count > 0 {
-        let zeros = Tensor::zeros_like(t)?;
-        let mask = mask_u8.gt(0u8)?;
-        // Candle where_cond: mask.where_cond(on_true, on_false)
-        mask.where_cond(&zeros, t)
-    } else {
-        Ok(t.clone())
+    // Branch-free on purpose: counting the corrupted elements first forced a
+    // device->host readback in every block of every decode step.
+    // A single comparison covers both cases: NaN fails every comparison, so `|t| <= 1e30`
+    // is false exactly for NaN and for overflowed values.
+    let keep = t.abs()?.le(1e30f32)?;
+    let zeros = Tensor::zeros_like(t)?;
+    // Candle where_cond: mask.where_cond(on_true, on_false)
+    keep.where_cond(t, &zeros)
+}
+
+/// Per-layer attention state `(key, value)`, each shaped `(batch, n_head, seq, head_dim)`.
+pub type LayerKv = (Tensor, Tensor);
+
+/// Token selection for the T3 decode loop.
+#[derive(Debug, Clone)]
+pub struct SamplingConfig {
+    /// Softmax temperature; `0.0` selects greedily (argmax).
+    pub temperature: f64,
+    /// Penalty applied to logits of already generated tokens; `1.0` disables it.
+    pub repetition_penalty: f64,
+    /// Restricts sampling to the `top_k` highest logits; `0` disables it.
+    pub top_k: usize,
+}
+
+impl Default for SamplingConfig {
+    fn default() -> Self {
+        Self { temperature: 0.0, repetition_penalty: 1.0, top_k: 0 }
+    }
+}
+
+impl SamplingConfig {
+    /// Reads `AGENCY_T3_TEMPERATURE`, `AGENCY_T3_REPETITION_PENALTY` and `AGENCY_T3_TOP_K`,
+    /// falling back to plain greedy decoding.
+    pub fn from_env() -> Self {
+        let parse = |name: &str| std::env::var(name).ok().and_then(|v| v.parse::<f64>().ok());
+        let temperature = parse("AGENCY_T3_TEMPERATURE")
+            .filter(|t| t.is_finite() && *t >= 0.0)
+            .unwrap_or(0.0);
+        let repetition_penalty = parse("AGENCY_T3_REPETITION_PENALTY")
+            .filter(|p| p.is_finite() && *p > 0.0)
+            .unwrap_or(1.0);
+        let top_k = std::env::var("AGENCY_T3_TOP_K")
+            .ok()
+            .and_then(|v| v.parse::<usize>().ok())
+            .unwrap_or(0);
+        Self { temperature, repetition_penalty, top_k }
+    }
+}
+
+/// Applies the repetition penalty and top-k filter to `logits` (B, V) in place of a
+/// logits-processor chain over the growing `input_ids`: `seen` is a (B, V) u8 mask of the
+/// tokens generated so far, so each step costs O(V) rather than O(step * V).
+fn process_logits(logits: &Tensor, seen: &Tensor, sampling: &SamplingConfig) -> Result<Tensor> {
+    let mut logits = logits.clone();
+    if sampling.repetition_penalty != 1.0 {
+        let p = sampling.repetition_penalty;
+        let penalized = logits.ge(0f32)?.where_cond(&(&logits / p)?, &(&logits * p)?)?;
+        logits = seen.where_cond(&penalized, &logits)?;
+    }
+    // Top-k cannot change a greedy pick, so it only runs when sampling
+    let vocab = logits.dim(D::Minus1)?;
+    if sampling.temperature > 0.0 && sampling.top_k > 0 && sampling.top_k < vocab {
+        let (sorted, _) = logits.sort_last_dim(false)?;
+        let kth = sorted.narrow(D::Minus1, sampling.top_k - 1, 1)?;
+        let neg_inf = Tensor::full(f32::NEG_INFINITY, logits.dims(), logits.device())?;
+        logits = logits.broadcast_ge(&kth)?.where_cond(&logits, &neg_inf)?;
+    }
+    Ok(logits)
+}
+
+/// Picks one token per row of `logits` (B, V) without leaving the device. With a positive
+/// temperature this is Gumbel-max sampling, argmax(logits / T + G) with G ~ Gumbel(0, 1),
+/// which draws from softmax(logits / T) without a softmax, CDF scan or host sync.
+fn select_tokens(logits: &Tensor, sampling: &SamplingConfig) -> Result<Tensor> {
+    if sampling.temperature <= 0.0 {
+        return logits.argmax(D::Minus1);
     }
+    let u = Tensor::rand(0f32, 1f32, logits.dims(), logits.device())?;
+    (logits / sampling.temperature)?.add(&gumbel_from_uniform(&u)?)?.argmax(D::Minus1)
 }
 
+/// Maps uniform draws to Gumbel(0, 1) noise, -log(-log(u)). Backends differ on whether the
+/// draw can hit 0 or 1 (cuRAND's uniform is (0, 1]); either end would yield an infinite
+/// sample that wins the argmax outright, so `u` is kept strictly inside the interval.
+fn gumbel_from_uniform(u: &Tensor) -> Result<Tensor> {
+    let u = u.clamp(f32::MIN_POSITIVE, 1.0 - f32::EPSILON)?;
+    u.log()?.neg()?.log()?.neg()
+}
+
+/// Per-layer key/value storage that outlives a single generation, like HF's `StaticCache`:
+/// the buffer is allocated once for the reserved capacity and the batch in use, and later
+/// utterances only rewind the write position. It is reallocated only when the batch size,
+/// dtype or device changes or a write would overrun it.
 #[derive(Debug)]
+struct KvBuffer {
+    k: Option<Tensor>,
+    v: Option<Tensor>,
+    len: usize,
+    capacity: usize,
+}
+
+impl KvBuffer {
+    fn new() -> Self {
+        Self { k: None, v: None, len: 0, capacity: 0 }
+    }
+
+    /// Rewinds the write position, keeping the storage for the next sequence.
+    fn reset(&mut self) {
+        self.len = 0;
+    }
+
+    /// Rewinds and raises the capacity hint to at least `capacity` positions. Storage that
+    /// is already large enough is kept as is.
+    fn reserve(&mut self, capacity: usize) {
+        self.len = 0;
+        self.capacity = self.capacity.max(capacity);
+    }
+
+    /// Live `(key, value)` views, shaped `(batch, n_head, len, head_dim)`.
+    fn current(&self) -> Result<Option<LayerKv>> {
+        match (&self.k, &self.v) {
+            (Some(k), Some(v)) if self.len > 0 => Ok(Some((k.narrow(2, 0, self.len)?, v.narrow(2, 0, self.len)?))),
+            _ => Ok(None),
+        }
+    }
+
+    fn append(&mut self, k: &Tensor, v: &Tensor) -> Result<LayerKv> {
+        let (b_sz, n_head, seq_len, head_dim) = k.dims4()?;
+        let needed = self.len + seq_len;
+        let reusable = match &self.k {
+            Some(buf) => buf.dim(0)? == b_sz
+                && buf.dtype() == k.dtype()
+                && buf.device().same_device(k.device())
+                && buf.dim(2)? >= needed.max(self.capacity),
+            None => false,
+        };
+        if !reusable {
+            let capacity = needed.max(self.capacity);
+            let new_k = Tensor::zeros((b_sz, n_head, capacity, head_dim), k.dtype(), k.device())?;
+            let new_v = Tensor::zeros((b_sz, n_head, capacity, head_dim), v.dtype(), v.device())?;
+            // Growing mid-sequence carries the live prefix over
+            if let Some((old_k, old_v)) = self.current()? {
+                new_k.slice_set(&old_k.contiguous()?, 2, 0)?;
+                new_v.slice_set(&old_v.contiguous()?, 2, 0)?;
+            }
+            self.k = Some(new_k);
+            self.v = Some(new_v);
+        }
+        if let (Some(buf_k), Some(buf_v)) = (&self.k, &self.v) {
+            buf_k.slice_set(&k.contiguous()?, 2, self.len)?;
+            buf_v.slice_set(&v.contiguous()?, 2, self.len)?;
+        }
+        self.len = needed;
+        self.current()?.ok_or_else(|| candle_core::Error::Msg("empty KV append".to_string()))
+    }
+}
+
+/// Decoding writes the storage in place, so a clone must never share it: it starts empty,
+/// keeping only the capacity hint.
+impl Clone for KvBuffer {
+    fn clone(&self) -> Self {
+        Self { capacity: self.capacity, ..Self::new() }
+    }
+}
+
+#[derive(Debug, Clone)]
 pub struct Attention {
     c_attn: UnifiedLinear,
     c_proj: UnifiedLinear,
     n_head: usize,
     head_dim: usize,
-    kv_cache: Option<(Tensor, Tensor)>,
+    kv_cache: KvBuffer,
 }
 
 impl Attention {
@@ -94,57 +269,62 @@ impl Attention {
         let n_head = cfg.n_head;
         let head_dim = n_embd / n_head;
         
-        let c_attn = load_linear(weights, &format!("{}.attn.c_attn", prefix), n_embd, 3 * n_embd, device)?;
-        let c_proj = load_linear(weights, &format!("{}.attn.c_proj", prefix), n_embd, n_embd, device)?;
+        let c_attn = load_projection(weights, &format!("{}.attn.c_attn", prefix), n_embd, 3 * n_embd, device)?;
+        let c_proj = load_projection(weights, &format!("{}.attn.c_proj", prefix), n_embd, n_embd, device)?;
         Ok(Self {
             c_attn,
             c_proj,
             n_head,
             head_dim,
-            kv_cache: None,
+            kv_cache: KvBuffer::new(),
         })
     }
 
     fn forward(&mut self, x: &Tensor, mask: Option<&Tensor>) -> Result<Tensor> {
         let (b_sz, seq_len, n_embd) = x.dims3()?;
         let x_dtype = x.dtype();
+        // One fused GEMM for q/k/v: a single pass over x and one kernel launch, where
+        // three separate projections would each re-read the activations.
         let qkv = self.c_attn.forward(x)?;
         let qkv = qkv.to_dtype(DType::F32)?.reshape((b_sz, seq_len, 3, self.n_head, self.head_dim))?;
-        let qkv = qkv.transpose(1, 3)?; 
-        
+
         // SOTA: Clamp projections to prevent explosion before matmul
-        let mut q = qkv.narrow(2, 0, 1)?.squeeze(2)?.contiguous()?; 
-        let mut k = qkv.narrow(2, 1, 1)?.squeeze(2)?.contiguous()?; 
-        let mut v = qkv.narrow(2, 2, 1)?.squeeze(2)?.contiguous()?; 
-        
         // SOTA 6.2: Universal Articulation - wide activation guards for harmonics
-        q = q.clamp(-150.0f32, 150.0f32)?;
-        k = k.clamp(-150.0f32, 150.0f32)?;
-        v = v.clamp(-150.0f32, 150.0f32)?;
+        let qkv = qkv.clamp(-150.0f32, 150.0f32)?;
+
+        // A single relayout to (3, B, H, S, D) makes q, k and v contiguous slices of one
+        // buffer, instead of three strided narrow + copy passes.
+        let qkv = qkv.permute((2, 0, 3, 1, 4))?.contiguous()?;
+        let q = qkv.get(0)?;
+        let k = qkv.get(1)?;
+        let v = qkv.get(2)?;
         
-        if let Some((prev_k, prev_v)) = &self.kv_cache {
-            // SOTA: Secure concatenation with device-local contiguity
-            k = Tensor::cat(&[prev_k, &k], 2)?.contiguous()?;
-            v = Tensor::cat(&[prev_v, &v], 2)?.contiguous()?;
-        }
-        // SOTA 6.2: Lead Sanctuary 4.0 - articulate containment
-        self.kv_cache = Some((k.clamp(-150.0f32, 150.0f32)?, v.clamp(-150.0f32, 150.0f32)?));
+        // SOTA 6.2: Lead Sanctuary 4.0 - articulate containment. New keys/values are
+        // already clamped, so writing them into the preallocated buffer keeps every cached
+        // entry in range without re-clamping (or re-concatenating) the whole history.
+        let (k, v) = self.kv_cache.append(&k, &v)?;
+        let v = v.contiguous()?;
 
-        // SOTA 6.2: Silicon Fortress - expressive matmul clamp
-        let att_raw = q.matmul(&k.transpose(D::Minus2, D::Minus1)?.contiguous()?)?;
-        let att = (att_raw.clamp(-500.0f32, 500.0f32)? / (self.head_dim as f64).sqrt())?;
+        // The 1/sqrt(d) scale is folded into q (exact for power-of-two head dims), so the
+        // scores come out of a single matmul already scaled.
+        let scale = 1.0 / (self.head_dim as f64).sqrt();
+        let q = (q * scale)?;
+        let att = q.matmul(&k.transpose(D::Minus2, D::Minus1)?.contiguous()?)?;
         
-        // SOTA 6.0: The Titanium Barrier - absolute protection for exp() before softmax
-        let att_f32 = att.to_dtype(DType::F32)?.clamp(-60.0f32, 60.0f32)?;
+        // SOTA 6.2: Silicon Fortress - expressive matmul clamp (+/-500 on the raw scores) and
+        // SOTA 6.0: The Titanium Barrier - absolute protection for exp() before softmax (+/-60),
+        // merged into one clamp on the scaled scores
+        let limit = (500.0 * scale).min(60.0) as f32;
+        let att = att.clamp(-limit, limit)?;
         
-        let mut att_f32 = if let Some(mask) = mask {
-            att_f32.broadcast_add(&mask.to_dtype(DType::F32)?)?
+        let att = if let Some(mask) = mask {
+            att.broadcast_add(&mask.to_dtype(DType::F32)?)?
         } else {
-            att_f32
+            att
         };
         
-        att_f32 = candle_nn::ops::softmax(&att_f32, D::Minus1)?;
-        let att = att_f32.to_dtype(x_dtype)?;
+        // Fused single-kernel softmax over the key axis
+        let att = candle_nn::ops::softmax_last_dim(&att)?.to_dtype(x_dtype)?;
         
         let y = att.matmul(&v)?; 
         let y = y.transpose(1, 2)?.reshape((b_sz, seq_len, n_embd))?;
@@ -154,11 +334,28 @@ impl Attention {
     }
 
     fn clear_cache(&mut self) {
-        self.kv_cache = None;
+        self.kv_cache.reset();
+    }
+
+    fn past(&self) -> Result<Option<LayerKv>> {
+        match self.kv_cache.current()? {
+            // Copy only the live positions out of the shared buffer, so later in-place appends
+            // cannot alias the snapshot (`copy` would duplicate the whole backing storage).
+            Some((k, v)) => Ok(Some((k.force_contiguous()?, v.force_contiguous()?))),
+            None => Ok(None),
+        }
+    }
+
+    fn set_past(&mut self, past: Option<LayerKv>) -> Result<()> {
+        self.kv_cache.reset();
+        if let Some((k, v)) = past {
+            self.kv_cache.append(&k, &v)?;
+        }
+        Ok(())
     }
 }
 
-#[derive(Debug)]
+#[derive(Debug, Clone)]
 pub struct MLP {
     c_fc: UnifiedLinear,
     c_proj: UnifiedLinear,
@@ -168,8 +365,8 @@ impl MLP {
     fn load(weights: &HashMap<String, Tensor>, prefix: &str, cfg: &Config, device: &Device) -> Result<Self> {
         let n_embd = cfg.n_embd;
         let n_inner = n_embd * 4;
-        let c_fc = load_linear(weights, &format!("{}.mlp.c_fc", prefix), n_embd, n_inner, device)?;
-        let c_proj = load_linear(weights, &format!("{}.mlp.c_proj", prefix), n_inner, n_embd, device)?;
+        let c_fc = load_projection(weights, &format!("{}.mlp.c_fc", prefix), n_embd, n_inner, device)?;
+        let c_proj = load_projection(weights, &format!("{}.mlp.c_proj", prefix), n_inner, n_embd, device)?;
         Ok(Self { c_fc, c_proj })
     }
 
@@ -183,7 +380,7 @@ impl MLP {
     }
 }
 
-#[derive(Debug)]
+#[derive(Debug, Clone)]
 pub struct Block {
     ln_1: LayerNorm,
     attn: Attention,
@@ -209,6 +406,8 @@ impl Block {
         Ok(Self { ln_1, attn, ln_2, mlp })
     }
 
+    // The LayerNorm inputs are always contiguous (fresh clamp outputs), which keeps candle on
+    // its fused layer_norm kernel rather than the op-by-op mean/variance fallback.
     fn forward(&mut self, x: &Tensor, mask: Option<&Tensor>) -> Result<Tensor> {
         let x = x.to_dtype(DType::F32)?;
         // SOTA 6.3: Harmonic entry guard
@@ -220,14 +419,18 @@ impl Block {
         let residual = &x;
         let x = self.ln_2.forward(&x)?;
         let x = self.mlp.forward(&x)?;
-        let x = (x + residual)?.clamp(-400.0f32, 400.0f32)?; // SOTA: Harmonic Shield Addition
-        // SOTA 6.3: Final block-level harmonic cage and sanitization
-        let x = x.clamp(-400.0f32, 400.0f32)?;
+        // SOTA: Harmonic Shield Addition, doubling as the SOTA 6.3 final block-level cage
+        let x = (x + residual)?.clamp(-400.0f32, 400.0f32)?;
+        // SOTA 6.3: block-level sanitization
         sanitize(&x)
     }
 }
 
-#[derive(Debug)]
+/// Cloning yields a second instance over the same weights, for serving concurrent requests
+/// from one load. Tensors are reference-counted, so parameters (and the cached conditioning
+/// KV) are shared rather than copied; only the per-layer KV buffers, which decoding writes in
+/// place, start out empty and private to the clone.
+#[derive(Debug, Clone)]
 pub struct T3Candle {
     pub wte: Embedding,
     wpe: Embedding,
@@ -235,6 +438,7 @@ pub struct T3Candle {
     ln_f: LayerNorm,
     speech_head: UnifiedLinear,
     t3_cond_emb: Tensor,
+    cond_past: Option<Vec<Option<LayerKv>>>,
 }
 
 impl T3Candle {
@@ -273,8 +477,8 @@ impl T3Candle {
             }
         };
         
-        let speech_head = load_linear(weights, "speech_head", cfg.n_embd, 6563, device)?;
-        Ok(Self { wte, wpe, h, ln_f, speech_head, t3_cond_emb })
+        let speech_head = load_projection(weights, "speech_head", cfg.n_embd, SPEECH_VOCAB_SIZE, device)?;
+        Ok(Self { wte, wpe, h, ln_f, speech_head, t3_cond_emb, cond_past: None })
     }
 
     pub fn forward(&mut self, text_tokens: &Tensor, mask: Option<&Tensor>) -> Result<Tensor> {
@@ -327,133 +531,587 @@ impl T3Candle {
         }
     }
 
-    pub fn generate_tokens_internal_static(
+    /// Dtype the transformer projections actually compute in; `None` when they run on packed
+    /// Q8_0 kernels, which `cast_weights` leaves as they are.
+    pub fn projection_dtype(&self) -> Option<DType> {
+        self.h.first().and_then(|block| block.attn.c_attn.compute_dtype())
+    }
+
+    /// Casts every projection (attention, MLP and speech head) to `dtype`. Embeddings,
+    /// LayerNorms and attention scores stay in F32 for numerical headroom.
+    pub fn cast_weights(&mut self, dtype: DType) -> Result<()> {
+        for block in self.h.iter_mut() {
+            block.attn.c_attn.to_compute_dtype(dtype)?;
+            block.attn.c_proj.to_compute_dtype(dtype)?;
+            block.mlp.c_fc.to_compute_dtype(dtype)?;
+            block.mlp.c_proj.to_compute_dtype(dtype)?;
+        }
+        // Cached conditioning KV was produced by the old weights
+        self.cond_past = None;
+        self.speech_head.to_compute_dtype(dtype)
+    }
+
+    /// Clears the KV state and makes each layer's buffer hold at least `capacity` positions,
+    /// so decoding writes in place instead of reallocating every step. Buffers persist across
+    /// calls: storage is only allocated when the reservation, batch size or dtype grows or
+    /// changes, not once per utterance.
+    pub fn reserve_kv_cache(&mut self, capacity: usize) {
+        for block in self.h.iter_mut() {
+            block.attn.kv_cache.reserve(capacity);
+        }
+    }
+
+    /// Snapshot of the per-layer KV state (`past_key_values`), one entry per block.
+    pub fn past_key_values(&self) -> Result<Vec<Option<LayerKv>>> {
+        self.h.iter().map(|block| block.attn.past()).collect()
+    }
+
+    /// Replaces the per-layer KV state, e.g. with a snapshot taken by `past_key_values`.
+    pub fn set_past_key_values(&mut self, past: Vec<Option<LayerKv>>) -> Result<()> {
+        if past.len() != self.h.len() {
+            candle_core::bail!("Expected {} past_key_values entries, got {}", self.h.len(), past.len());
+        }
+        for (block, layer_past) in self.h.iter_mut().zip(past) {
+            block.attn.set_past(layer_past)?;
+        }
+        Ok(())
+    }
+
+    /// Number of positions currently held in the KV state.
+    pub fn past_len(&self) -> usize {
+        self.h.first().map(|block| block.attn.kv_cache.len).unwrap_or(0)
+    }
+
+    /// Positional embeddings for `len` positions starting at `start`, shaped `(1, len, n_embd)`.
+    /// Slices the table on-device instead of gathering through a host-built index tensor.
+    fn wpe_range(&self, start: usize, len: usize) -> Result<Tensor> {
+        self.wpe.embeddings().narrow(0, start, len)?.unsqueeze(0)
+    }
+
+    /// KV state of the speaker-conditioning prefix (batch 1). The condition never attends to
+    /// the text that follows it, so its keys/values are computed once per model and restored
+    /// for every utterance instead of being re-run through all layers in each prefill.
+    fn cond_past(&mut self) -> Result<Vec<Option<LayerKv>>> {
+        if let Some(past) = &self.cond_past {
+            return Ok(past.clone());
+        }
+        let n_cond = self.t3_cond_emb.dim(1)?;
+        let device = self.t3_cond_emb.device().clone();
+
+        // Condition Positional Coating
+        let cond_wpe = self.wpe_range(0, n_cond)?.to_dtype(DType::F32)?;
+        let cond_ready = (self.t3_cond_emb.to_dtype(DType::F32)? + cond_wpe)?;
+        let mask = if n_cond > 1 {
+            let m: Vec<_> = (0..n_cond).flat_map(|ii| (0..n_cond).map(move |jj| {
+                if jj <= ii { 0.0f32 } else { -1e9f32 }
+            })).collect();
+            Some(Tensor::from_vec(m, (n_cond, n_cond), &device)?)
+        } else {
+            None
+        };
+
+        self.reserve_kv_cache(n_cond);
+        self.forward_positioned(&cond_ready, mask.as_ref())?;
+        let past = self.past_key_values()?;
+        self.cond_past = Some(past.clone());
+        Ok(past)
+    }
+
+    /// Prepares the model for serving: computes and caches the conditioning-prefix KV state and
+    /// runs one decode step of `start_token` on top of it, the same first step a generation
+    /// takes. On GPU backends this compiles the prefill and decode kernels up front, so the
+    /// first utterance does not pay for it. It does not size the KV buffers for a full
+    /// utterance; each generation reserves its own capacity.
+    pub fn warmup(&mut self, speech_emb: &Embedding, start_token: u32) -> Result<()> {
+        let past = self.cond_past()?;
+        let n_cond = self.t3_cond_emb.dim(1)?;
+        self.reserve_kv_cache(n_cond + 1);
+        self.set_past_key_values(past)?;
+
+        let token = Tensor::full(start_token, (1, 1), self.t3_cond_emb.device())?;
+        let embeds = (speech_emb.forward(&token)?.to_dtype(DType::F32)? + self.wpe_range(n_cond, 1)?.to_dtype(DType::F32)?)?;
+        self.forward_positioned(&embeds, None)?;
+        self.clear_cache();
+        Ok(())
+    }
+
+    /// Runs the transformer stack and speech head over inputs that already carry their
+    /// positional encoding, appending the new keys/values to the KV state.
+    fn forward_positioned(&mut self, embeds: &Tensor, mask: Option<&Tensor>) -> Result<Tensor> {
+        // SOTA 6.1: forward_block bypasses forward_embeds to avoid double WPE application
+        let mut x = embeds.to_dtype(DType::F32)?;
+        for block in self.h.iter_mut() {
+            x = block.forward(&x, mask)?;
+        }
+        let x = self.ln_f.forward(&x)?;
+        self.speech_head.forward(&x.clamp(-300.0f32, 300.0f32)?)
+    }
+
+    /// Generates speech tokens for several independent texts in one batched decode, so each
+    /// step streams the weights once for all rows. Texts are left-padded between the shared
+    /// condition prefix and the speech start token; padded keys are masked out and every row
+    /// keeps its own positions, so a single text produces exactly the unbatched result.
+    pub fn generate_tokens_batch_static(
         t3_model: &mut crate::models::t3_candle::T3Candle,
         tokenizer: &Tokenizer,
-        text: &str,
+        texts: &[String],
         speech_emb: &Embedding,
         device: &Device,
         start_token: i64,
-        stop_token: i64
-    ) -> Result<Vec<i64>> {
+        stop_token: i64,
+        sampling: &SamplingConfig
+    ) -> Result<Vec<Vec<i64>>> {
+        let b_sz = texts.len();
+        if b_sz == 0 {
+            return Ok(Vec::new());
+        }
         let weight_dtype = speech_emb.embeddings().dtype();
-        let mut clean_text = text.trim().to_string();
-        if !clean_text.ends_with('.') && !clean_text.ends_with('!') && !clean_text.ends_with('?') {
-            clean_text.push('.');
+
+        let mut text_ids: Vec<Vec<u32>> = Vec::with_capacity(b_sz);
+        for text in texts {
+            let mut clean_text = text.trim().to_string();
+            if !clean_text.ends_with('.') && !clean_text.ends_with('!') && !clean_text.ends_with('?') {
+                clean_text.push('.');
+            }
+            let encoding = tokenizer.encode(clean_text, true).map_err(|e| candle_core::Error::Msg(e.to_string()))?;
+            text_ids.push(encoding.get_ids().to_vec());
         }
+        let max_text_len = text_ids.iter().map(|ids| ids.len()).max().unwrap_or(0);
+        let pads: Vec<usize> = text_ids.iter().map(|ids| max_text_len - ids.len()).collect();
+        let has_padding = pads.iter().any(|&p| p > 0);
 
-        let encoding = tokenizer.encode(clean_text, true).map_err(|e| candle_core::Error::Msg(e.to_string()))?;
-        let text_ids: Vec<u32> = encoding.get_ids().iter().map(|&x| x as u32).collect();
         // SOTA 7.1: Correct global positional alignment
         // [Condition (unindexed?)] + [Text (indexed 0..N)] + [Speech (indexed N..M)]
         // Actually, Python suggests EVERYTHING is indexed. 
         // Let's align text starting from n_cond.
         let n_cond = t3_model.t3_cond_emb.dim(1)?;
+        let n_embd = t3_model.t3_cond_emb.dim(2)?;
+        // Logical length of each row's [Condition + Text] prefix, ignoring padding
+        let row_prefix_lens: Vec<usize> = text_ids.iter().map(|ids| n_cond + ids.len()).collect();
         
-        // 1. Condition Positional Coating
-        let cond_pos = Tensor::arange(0u32, n_cond as u32, device)?;
-        let cond_wpe = t3_model.wpe.forward(&cond_pos)?.to_dtype(weight_dtype)?;
-        let cond_ready = (t3_model.t3_cond_emb.clone().to_dtype(weight_dtype)? + cond_wpe.unsqueeze(0)?)?;
-
-        // 2. Text Positional Coating
-        let text_ids_tensor = Tensor::from_vec(text_ids.clone(), (1, text_ids.len()), device)?;
-        let text_pos = Tensor::arange(n_cond as u32, (n_cond + text_ids.len()) as u32, device)?;
+        // 1. Condition: restored from the cached KV state, shared by every row
+        let cond_past = t3_model.cond_past()?;
+
+        // 2. Text Positional Coating, left-padded to the longest text
+        let (padded_ids, text_pos) = left_pad_text(&text_ids, max_text_len, n_cond);
+        let text_ids_tensor = Tensor::from_vec(padded_ids, (b_sz, max_text_len), device)?;
+        let text_pos_tensor = Tensor::from_vec(text_pos, (b_sz, max_text_len), device)?;
         let text_embeds = t3_model.wte.forward(&text_ids_tensor)?.to_dtype(weight_dtype)?;
-        let text_wpe = t3_model.wpe.forward(&text_pos)?.to_dtype(weight_dtype)?;
-        let text_ready = (text_embeds + text_wpe.unsqueeze(0)?)?;
+        let text_wpe = t3_model.wpe.forward(&text_pos_tensor)?.to_dtype(weight_dtype)?;
+        let text_ready = (text_embeds + text_wpe)?;
 
-        // Concatenate condition with ready text
-        let prefix_embeds = Tensor::cat(&[cond_ready, text_ready], 1)?;
-        let prefix_len = prefix_embeds.dim(1)?;
+        // Only the text is prefilled; the condition already sits in the KV state
+        let prefix_embeds = text_ready;
+        let prefix_len = n_cond + max_text_len;
 
-        t3_model.clear_cache();
-        let mut speech_ids = vec![start_token as u32];
+        let padding_mask = |q_len: usize, kv_len: usize, causal: bool| -> Result<Tensor> {
+            let m = padding_mask_values(&pads, n_cond, q_len, kv_len, causal);
+            Tensor::from_vec(m, (b_sz, 1, q_len, kv_len), device)?.to_dtype(weight_dtype)
+        };
+
+        let kv_capacity = prefix_len + MAX_SPEECH_TOKENS + 1;
+        t3_model.reserve_kv_cache(kv_capacity);
+        // Pad columns are fixed for the whole generation, so the decode-step mask is
+        // uploaded once at full capacity and only narrowed to the live KV length per step
+        let decode_mask = if has_padding {
+            Some(padding_mask(1, kv_capacity, false)?)
+        } else {
+            None
+        };
+        let batched_past = cond_past.into_iter().map(|layer| {
+            layer.map(|(k, v)| -> Result<LayerKv> {
+                let (_, h, n, d) = k.dims4()?;
+                Ok((
+                    k.broadcast_as((b_sz, h, n, d))?.contiguous()?,
+                    v.broadcast_as((b_sz, h, n, d))?.contiguous()?,
+                ))
+            }).transpose()
+        }).collect::<Result<Vec<_>>>()?;
+        t3_model.set_past_key_values(batched_past)?;
+        let mut speech_ids: Vec<Vec<u32>> = (0..b_sz).map(|_| {
+            let mut ids = Vec::with_capacity(MAX_SPEECH_TOKENS + 1);
+            ids.push(start_token as u32);
+            ids
+        }).collect();
+        let mut finished = vec![false; b_sz];
+
+        // Seen-token mask for the repetition penalty, seeded with the speech start token
+        let vocab_ids = Tensor::arange(0u32, SPEECH_VOCAB_SIZE as u32, device)?.unsqueeze(0)?;
+        let start_ids = Tensor::full(start_token as u32, (b_sz, 1), device)?;
+        let mut seen = vocab_ids.broadcast_eq(&start_ids)?;
+        
+        // Step i means row r is at logical position row_prefix_lens[r] + i. The whole table is
+        // uploaded once so decode steps only slice it on-device.
+        let step_positions: Vec<u32> = row_prefix_lens.iter()
+            .flat_map(|&l| (0..MAX_SPEECH_TOKENS).map(move |i| (l + i) as u32))
+            .collect();
+        let step_positions = Tensor::from_vec(step_positions, (b_sz, MAX_SPEECH_TOKENS), device)?;
         
+        // Chosen ids stay on-device and feed the next step directly; on GPUs the host only
+        // scans for stops every SYNC_INTERVAL steps. Whatever a row produces after it
+        // finishes is discarded, so the result matches syncing every step. On CPU there is
+        // no queue to drain, and a deferred check would only run extra decode steps.
+        let sync_interval = if device.is_cpu() { 1 } else { SYNC_INTERVAL };
+        let silence = Tensor::full(4299u32, b_sz, device)?;
+        let mut last_ids: Option<Tensor> = None;
+        let mut window: Vec<Tensor> = Vec::with_capacity(sync_interval);
+        let mut window_start = 0;
+
         // SOTA: Optimized loop
-        for i in 0..1024 {
-            let input_embeds = if i == 0 {
-                let speech_start_id = Tensor::from_vec(vec![start_token as u32], (1, 1), device)?;
-                // Apply positional encoding to speech start token correctly (at index prefix_len)
-                let speech_pos = Tensor::from_vec(vec![prefix_len as u32], (1, 1), device)?;
-                let speech_start_embeds = speech_emb.forward(&speech_start_id)?;
-                // wpe.forward on (1,1) already returns (1,1,1024)
-                let speech_start_wpe = t3_model.wpe.forward(&speech_pos)?.to_dtype(weight_dtype)?;
-                let speech_ready = (speech_start_embeds + speech_start_wpe)?;
-                Tensor::cat(&[&prefix_embeds, &speech_ready], 1)?
-            } else {
-                let last_id = Tensor::from_vec(vec![*speech_ids.last().unwrap()], (1, 1), device)?;
-                // Step i means we are at position prefix_len + i
-                let cur_pos = (prefix_len + i) as u32;
-                let cur_pos_tensor = Tensor::from_vec(vec![cur_pos], (1, 1), device)?;
-                let emb = speech_emb.forward(&last_id)?;
-                let wpe = t3_model.wpe.forward(&cur_pos_tensor)?.to_dtype(weight_dtype)?;
-                (emb + wpe)?
+        for i in 0..MAX_SPEECH_TOKENS {
+            let step_wpe = t3_model.wpe.forward(&step_positions.narrow(1, i, 1)?)?.to_dtype(weight_dtype)?;
+
+            let input_embeds = match &last_ids {
+                None => {
+                    let speech_start_id = Tensor::from_vec(vec![start_token as u32], (1, 1), device)?;
+                    // Apply positional encoding to speech start token correctly (at index prefix_len)
+                    let speech_start_embeds = speech_emb.forward(&speech_start_id)?.broadcast_as((b_sz, 1, n_embd))?;
+                    let speech_ready = (speech_start_embeds + step_wpe)?;
+                    Tensor::cat(&[&prefix_embeds, &speech_ready], 1)?
+                }
+                // Finished rows keep being fed; their outputs are ignored
+                Some(ids) => (speech_emb.forward(ids)? + step_wpe)?,
             };
 
             let seq_len = input_embeds.dim(1)?;
             let kv_len = prefix_len + i + 1;
             
             let mask = if seq_len > 1 {
-                let m: Vec<_> = (0..seq_len).flat_map(|ii| (0..kv_len).map(move |jj| {
-                    if jj <= ii + kv_len - seq_len { 0.0f32 } else { -1e9f32 }
-                })).collect();
-                Some(Tensor::from_vec(m, (seq_len, kv_len), device)?.to_dtype(weight_dtype)?)
+                Some(padding_mask(seq_len, kv_len, true)?)
+            } else if let Some(mask) = &decode_mask {
+                Some(mask.narrow(3, 0, kv_len)?)
             } else {
                 None
             };
 
-            // SOTA 6.1: forward_block bypasses forward_embeds to avoid double WPE application
-            let mut x = input_embeds.to_dtype(DType::F32)?;
-            for block in t3_model.h.iter_mut() {
-                x = block.forward(&x, mask.as_ref())?;
-            }
-            let x = t3_model.ln_f.forward(&x)?;
-            let logits = t3_model.speech_head.forward(&x.clamp(-300.0f32, 300.0f32)?)?;
+            let logits = t3_model.forward_positioned(&input_embeds, mask.as_ref())?;
             
-            let next_token_logits = logits.i((0, logits.dim(1)? - 1, ..))?
+            let next_token_logits = logits.i((.., logits.dim(1)? - 1, ..))?
                 .contiguous()?;
             
-            // SOTA: Sanitize logits before CPU argmax to prevent NaN-driven index jumps
-            let next_token_logits = sanitize(&next_token_logits)?
-                .to_device(&Device::Cpu)?;
-            
-            // SOTA: Early NaN/Inf detection - if still present after sanitization, bias towards silence
-            let sum = next_token_logits.sum_all()?.to_scalar::<f32>()?;
-            let next_token_logits = if sum.is_nan() || sum.is_infinite() {
-                tracing::warn!("Speaker SOTA: Model collapsed (NaN/Inf) at token index {}, defaulting to SILENCE (4299)", i);
-                let mut silence_logits = vec![-100.0f32; 6563];
-                silence_logits[4299] = 100.0f32; // Strongly bias towards silence
-                Tensor::from_vec(silence_logits, (6563,), &Device::Cpu)?
-            } else {
-                next_token_logits
-            };
+            // SOTA: Sanitize logits before selection to prevent NaN-driven index jumps
+            let next_token_logits = sanitize(&next_token_logits)?;
+            // SOTA: Early NaN/Inf detection - if still present after sanitization, bias towards silence.
+            // A NaN sum fails the comparison just like an infinite one.
+            let row_finite = next_token_logits.sum(1)?.abs()?.lt(f32::INFINITY)?;
+            let next_token_logits = process_logits(&next_token_logits, &seen, sampling)?;
+            let next_ids = select_tokens(&next_token_logits, sampling)?;
+            if sampling.repetition_penalty != 1.0 {
+                seen = seen.maximum(&vocab_ids.broadcast_eq(&next_ids.unsqueeze(1)?)?)?;
+            }
+            let fed_ids = row_finite.where_cond(&next_ids, &silence)?;
+            window.push(Tensor::stack(&[&fed_ids, &row_finite.to_dtype(DType::U32)?], 1)?);
+            last_ids = Some(fed_ids.unsqueeze(1)?);
 
-            let next_token = next_token_logits.flatten_all()?.argmax(D::Minus1)?.to_scalar::<u32>()?;
-            
-            // SOTA: Robust Range check - the decoder's voice vocab ends at 6561
-            if next_token >= 6561 && next_token < 6563 && next_token != stop_token as u32 {
-                tracing::warn!("Speaker SOTA: Model predicted meta-token {} at index {}, continuing...", next_token, i);
+            if window.len() < sync_interval && i + 1 < MAX_SPEECH_TOKENS {
+                continue;
             }
-            
-            if next_token >= 6563 {
-                tracing::error!("Speaker SOTA: Model collapsed to invalid index {} at token index {}", next_token, i);
-                break;
+            // (B, steps, [token, finite]) in a single transfer
+            let steps = Tensor::stack(&window, 1)?.to_vec3::<u32>()?;
+            window.clear();
+
+            for r in 0..b_sz {
+                scan_row(r, &mut speech_ids[r], &mut finished[r], &steps[r], window_start, stop_token as u32);
             }
+            window_start = i + 1;
+
+            if finished.iter().all(|&f| f) { break; }
+        }
+        
+        Ok(speech_ids.into_iter().map(|ids| ids.into_iter().map(|x| x as i64).collect()).collect())
+    }
+}
 
-            if next_token == stop_token as u32 { break; }
-            speech_ids.push(next_token);
+/// Left-pads each row's text ids to `max_len`, returning the flattened `(B, max_len)` ids and
+/// positions. Real tokens are numbered from `n_cond` exactly as if the row were alone; pad
+/// slots are pinned to `n_cond` and masked out by `padding_mask_values`.
+fn left_pad_text(text_ids: &[Vec<u32>], max_len: usize, n_cond: usize) -> (Vec<u32>, Vec<u32>) {
+    let mut padded_ids = Vec::with_capacity(text_ids.len() * max_len);
+    let mut positions = Vec::with_capacity(text_ids.len() * max_len);
+    for ids in text_ids {
+        let pad = max_len - ids.len();
+        padded_ids.extend(std::iter::repeat(0u32).take(pad));
+        padded_ids.extend_from_slice(ids);
+        positions.extend(std::iter::repeat(n_cond as u32).take(pad));
+        positions.extend((0..ids.len()).map(|j| (n_cond + j) as u32));
+    }
+    (padded_ids, positions)
+}
 
-            // SOTA: Trace the first few tokens to identify immediate EOS or collapse
-            if i < 5 {
-                tracing::debug!("Speaker SOTA: Step {}, predicted token {}", i, next_token);
-            }
-            
-            // Heuristic breakage for repetition loops which are not SOTA
-            if speech_ids.len() > 10 && speech_ids[speech_ids.len()-5..] == speech_ids[speech_ids.len()-10..speech_ids.len()-5] {
-                break;
+/// Additive attention mask for a left-padded batch, flattened from `(B, 1, q_len, kv_len)`.
+/// Row `r` cannot see its pad keys `n_cond..n_cond + pads[r]`; with `causal`, the queries
+/// (the last `q_len` of the `kv_len` positions) also cannot see keys after their own.
+fn padding_mask_values(pads: &[usize], n_cond: usize, q_len: usize, kv_len: usize, causal: bool) -> Vec<f32> {
+    let mut m = Vec::with_capacity(pads.len() * q_len * kv_len);
+    for &pad in pads {
+        for ii in 0..q_len {
+            for jj in 0..kv_len {
+                let is_pad = jj >= n_cond && jj < n_cond + pad;
+                let is_future = causal && jj > ii + kv_len - q_len;
+                m.push(if is_pad || is_future { -1e9f32 } else { 0.0f32 });
             }
         }
+    }
+    m
+}
+
+/// Applies one row's window of decode steps, each `[token, finite]` and starting at step
+/// `first_step`, with the same rules as a per-step check. Steps after the row finishes
+/// (stop token, invalid index or repetition loop) are ignored.
+fn scan_row(row: usize, ids: &mut Vec<u32>, finished: &mut bool, steps: &[Vec<u32>], first_step: usize, stop_token: u32) {
+    for (j, step) in steps.iter().enumerate() {
+        if *finished { break; }
+        let step_idx = first_step + j;
+        let next_token = step[0];
+
+        if step[1] == 0 {
+            tracing::warn!("Speaker SOTA: Model collapsed (NaN/Inf) at token index {}, defaulting to SILENCE (4299)", step_idx);
+        }
+        
+        // SOTA: Robust Range check - the decoder's voice vocab ends at 6561
+        if next_token >= 6561 && next_token < 6563 && next_token != stop_token {
+            tracing::warn!("Speaker SOTA: Model predicted meta-token {} at index {}, continuing...", next_token, step_idx);
+        }
+        
+        if next_token >= 6563 {
+            tracing::error!("Speaker SOTA: Model collapsed to invalid index {} at token index {}", next_token, step_idx);
+            *finished = true;
+            continue;
+        }
+
+        if next_token == stop_token {
+            *finished = true;
+            continue;
+        }
+        ids.push(next_token);
+
+        // SOTA: Trace the first few tokens to identify immediate EOS or collapse
+        if step_idx < 5 {
+            tracing::debug!("Speaker SOTA: Step {}, row {}, predicted token {}", step_idx, row, next_token);
+        }
         
-        Ok(speech_ids.into_iter().map(|x| x as i64).collect())
+        // Heuristic breakage for repetition loops which are not SOTA
+        if ids.len() > 10 && ids[ids.len()-5..] == ids[ids.len()-10..ids.len()-5] {
+            *finished = true;
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn sampling(temperature: f64, repetition_penalty: f64, top_k: usize) -> SamplingConfig {
+        SamplingConfig { temperature, repetition_penalty, top_k }
+    }
+
+    fn filled(b_sz: usize, seq_len: usize, value: f32) -> Tensor {
+        (Tensor::ones((b_sz, 2, seq_len, 4), DType::F32, &Device::Cpu).unwrap() * value as f64).unwrap()
+    }
+
+    fn positions(t: &Tensor) -> Vec<f32> {
+        // First element of every position of batch 0, head 0
+        t.get(0).unwrap().get(0).unwrap().narrow(1, 0, 1).unwrap().flatten_all().unwrap().to_vec1().unwrap()
+    }
+
+    fn storage_len(kv: &KvBuffer) -> usize {
+        kv.k.as_ref().unwrap().dim(2).unwrap()
+    }
+
+    #[test]
+    fn test_kv_buffer_appends_in_place_up_to_capacity() {
+        let mut kv = KvBuffer::new();
+        kv.reserve(8);
+        kv.append(&filled(1, 3, 1.0), &filled(1, 3, 1.0)).unwrap();
+        let (k, v) = kv.append(&filled(1, 2, 2.0), &filled(1, 2, 2.0)).unwrap();
+        assert_eq!(k.dims(), &[1, 2, 5, 4]);
+        assert_eq!(positions(&k), vec![1.0, 1.0, 1.0, 2.0, 2.0]);
+        assert_eq!(positions(&v), positions(&k));
+        assert_eq!(storage_len(&kv), 8);
+    }
+
+    #[test]
+    fn test_kv_buffer_reset_reuses_storage() {
+        let mut kv = KvBuffer::new();
+        kv.reserve(8);
+        kv.append(&filled(1, 4, 1.0), &filled(1, 4, 1.0)).unwrap();
+        let before = kv.k.as_ref().unwrap().clone();
+
+        kv.reset();
+        assert!(kv.current().unwrap().is_none());
+        let (k, _) = kv.append(&filled(1, 2, 3.0), &filled(1, 2, 3.0)).unwrap();
+        assert_eq!(positions(&k), vec![3.0, 3.0]);
+        // The rewound write landed in the storage allocated before the reset
+        assert_eq!(positions(&before)[..2], [3.0, 3.0]);
+
+        // A smaller reservation keeps the existing storage
+        kv.reserve(4);
+        kv.append(&filled(1, 1, 5.0), &filled(1, 1, 5.0)).unwrap();
+        assert_eq!(storage_len(&kv), 8);
+        assert_eq!(positions(&before)[0], 5.0);
+    }
+
+    #[test]
+    fn test_kv_buffer_grows_and_carries_live_prefix() {
+        let mut kv = KvBuffer::new();
+        kv.reserve(2);
+        kv.append(&filled(1, 2, 1.0), &filled(1, 2, 1.0)).unwrap();
+        let (k, _) = kv.append(&filled(1, 3, 2.0), &filled(1, 3, 2.0)).unwrap();
+        assert_eq!(positions(&k), vec![1.0, 1.0, 2.0, 2.0, 2.0]);
+        assert!(storage_len(&kv) >= 5);
+
+        // A larger reservation reallocates on the next sequence
+        kv.reserve(16);
+        kv.append(&filled(1, 1, 4.0), &filled(1, 1, 4.0)).unwrap();
+        assert_eq!(storage_len(&kv), 16);
+    }
+
+    #[test]
+    fn test_kv_buffer_reallocates_on_batch_or_dtype_change() {
+        let mut kv = KvBuffer::new();
+        kv.reserve(4);
+        kv.append(&filled(1, 2, 1.0), &filled(1, 2, 1.0)).unwrap();
+
+        kv.reset();
+        let (k, _) = kv.append(&filled(3, 2, 2.0), &filled(3, 2, 2.0)).unwrap();
+        assert_eq!(k.dims(), &[3, 2, 2, 4]);
+        assert_eq!(kv.k.as_ref().unwrap().dims(), &[3, 2, 4, 4]);
+
+        kv.reset();
+        let half = filled(3, 1, 1.0).to_dtype(DType::F16).unwrap();
+        let (k, _) = kv.append(&half, &half).unwrap();
+        assert_eq!(k.dtype(), DType::F16);
+        assert_eq!(k.dims(), &[3, 2, 1, 4]);
+    }
+
+    #[test]
+    fn test_kv_buffer_clone_does_not_share_storage() {
+        let mut kv = KvBuffer::new();
+        let ones = Tensor::ones((1, 2, 3, 4), DType::F32, &Device::Cpu).unwrap();
+        kv.reserve(8);
+        kv.append(&ones, &ones).unwrap();
+
+        let mut clone = kv.clone();
+        assert!(clone.current().unwrap().is_none());
+        let zeros = ones.zeros_like().unwrap();
+        clone.append(&zeros, &zeros).unwrap();
+
+        let (k, _) = kv.current().unwrap().unwrap();
+        assert_eq!(k.sum_all().unwrap().to_scalar::<f32>().unwrap(), 24.0);
+    }
+
+    #[test]
+    fn test_left_pad_keeps_unbatched_positions() {
+        let rows = vec![vec![7u32, 8], vec![1, 2, 3, 4]];
+        let (ids, pos) = left_pad_text(&rows, 4, 3);
+        assert_eq!(ids, vec![0, 0, 7, 8, 1, 2, 3, 4]);
+        // Row 0's real tokens sit at 3, 4 as they would alone; its pads are pinned to n_cond
+        assert_eq!(pos, vec![3, 3, 3, 4, 3, 4, 5, 6]);
+        let (alone_ids, alone_pos) = left_pad_text(&rows[..1], 2, 3);
+        assert_eq!((&ids[2..4], &pos[2..4]), (&alone_ids[..], &alone_pos[..]));
+    }
+
+    #[test]
+    fn test_padding_mask_mixed_lengths() {
+        const M: f32 = -1e9;
+        // n_cond = 1, texts of 1 and 3 tokens, prefill = 3 text slots + start token
+        let mask = padding_mask_values(&[2, 0], 1, 4, 5, true);
+        let row0: Vec<&[f32]> = mask[..20].chunks(5).collect();
+        let row1: Vec<&[f32]> = mask[20..].chunks(5).collect();
+        // Row 0 (query i sits at key i + 1) never sees its pad keys 1..3
+        assert_eq!(row0, vec![
+            &[0.0, M, M, M, M][..],
+            &[0.0, M, M, M, M][..],
+            &[0.0, M, M, 0.0, M][..],
+            &[0.0, M, M, 0.0, 0.0][..],
+        ]);
+        assert_eq!(row1, vec![
+            &[0.0, 0.0, M, M, M][..],
+            &[0.0, 0.0, 0.0, M, M][..],
+            &[0.0, 0.0, 0.0, 0.0, M][..],
+            &[0.0, 0.0, 0.0, 0.0, 0.0][..],
+        ]);
+
+        // Decode step: only the pad columns stay hidden
+        let step = padding_mask_values(&[2, 0], 1, 1, 6, false);
+        assert_eq!(step, vec![0.0, M, M, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]);
+    }
+
+    #[test]
+    fn test_scan_row_stops_and_ignores_the_rest_of_the_window() {
+        let mut ids = vec![6561];
+        let mut finished = false;
+        let steps = vec![vec![10, 1], vec![4299, 0], vec![6562, 1], vec![11, 1]];
+        scan_row(0, &mut ids, &mut finished, &steps, 0, 6562);
+        assert!(finished);
+        assert_eq!(ids, vec![6561, 10, 4299]);
+
+        // Windows arriving after the stop are ignored as well
+        scan_row(0, &mut ids, &mut finished, &[vec![12, 1]], 4, 6562);
+        assert_eq!(ids, vec![6561, 10, 4299]);
+    }
+
+    #[test]
+    fn test_scan_row_spans_windows_and_breaks_repetition_loops() {
+        let mut ids = vec![6561];
+        let mut finished = false;
+        let window = |toks: &[u32]| toks.iter().map(|&t| vec![t, 1]).collect::<Vec<_>>();
+        scan_row(0, &mut ids, &mut finished, &window(&[1, 2, 3, 4, 5]), 0, 6562);
+        assert!(!finished);
+        scan_row(0, &mut ids, &mut finished, &window(&[1, 2, 3, 4, 5, 9]), 5, 6562);
+        assert!(finished);
+        assert_eq!(ids, vec![6561, 1, 2, 3, 4, 5, 1, 2, 3, 4, 5]);
+    }
+
+    #[test]
+    fn test_repetition_penalty_sign_rule() {
+        let logits = Tensor::new(&[[2.0f32, -2.0, 1.0]], &Device::Cpu).unwrap();
+        let seen = Tensor::new(&[[1u8, 1, 0]], &Device::Cpu).unwrap();
+        let out = process_logits(&logits, &seen, &sampling(0.0, 2.0, 0)).unwrap();
+        // Seen positive logits are divided, seen negative ones multiplied, unseen untouched
+        assert_eq!(out.to_vec2::<f32>().unwrap(), vec![vec![1.0, -4.0, 1.0]]);
+    }
+
+    #[test]
+    fn test_top_k_keeps_ties_at_cutoff() {
+        let logits = Tensor::new(&[[3.0f32, 1.0, 3.0, 2.0]], &Device::Cpu).unwrap();
+        let seen = Tensor::zeros((1, 4), DType::U8, &Device::Cpu).unwrap();
+        let out = process_logits(&logits, &seen, &sampling(1.0, 1.0, 1)).unwrap();
+        let ninf = f32::NEG_INFINITY;
+        assert_eq!(out.to_vec2::<f32>().unwrap(), vec![vec![3.0, ninf, 3.0, ninf]]);
+    }
+
+    #[test]
+    fn test_top_one_sampling_is_deterministic() {
+        let logits = Tensor::new(&[[0.0f32, 5.0, 1.0], [4.0, 0.0, 1.0]], &Device::Cpu).unwrap();
+        let seen = Tensor::zeros((2, 3), DType::U8, &Device::Cpu).unwrap();
+        let cfg = sampling(1.0, 1.0, 1);
+        for _ in 0..8 {
+            let filtered = process_logits(&logits, &seen, &cfg).unwrap();
+            let ids = select_tokens(&filtered, &cfg).unwrap();
+            assert_eq!(ids.to_vec1::<u32>().unwrap(), vec![1, 0]);
+        }
+    }
+
+    #[test]
+    fn test_gumbel_noise_is_finite_at_interval_ends() {
+        let u = Tensor::new(&[0.0f32, 1.0, 0.5, 1e-30], &Device::Cpu).unwrap();
+        let noise = gumbel_from_uniform(&u).unwrap().to_vec1::<f32>().unwrap();
+        assert!(noise.iter().all(|g| g.is_finite()), "non-finite noise: {:?}", noise);
+
+        let u = Tensor::rand(0f32, 1f32, (4, SPEECH_VOCAB_SIZE), &Device::Cpu).unwrap();
+        let noise = gumbel_from_uniform(&u).unwrap().flatten_all().unwrap().to_vec1::<f32>().unwrap();
+        assert!(noise.iter().all(|g| g.is_finite()));
+    }
+
+    #[test]
+    fn test_greedy_passthrough_at_zero_temperature() {
+        let logits = Tensor::new(&[[0.5f32, 2.0, -1.0, 1.5]], &Device::Cpu).unwrap();
+        let seen = Tensor::zeros((1, 4), DType::U8, &Device::Cpu).unwrap();
+        // Top-k is skipped when decoding greedily, so the logits pass through unchanged
+        let cfg = sampling(0.0, 1.0, 2);
+        let out = process_logits(&logits, &seen, &cfg).unwrap();
+        assert_eq!(out.to_vec2::<f32>().unwrap(), logits.to_vec2::<f32>().unwrap());
+        assert_eq!(select_tokens(&out, &cfg).unwrap().to_vec1::<u32>().unwrap(), vec![1]);
     }
 }
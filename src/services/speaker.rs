@@ -4,7 +4,7 @@ use axum::{
     Json, Router,
 };
 use anyhow::Result;
-use candle_core::{Device, Tensor};
+use candle_core::{DType, Device, Tensor};
 use candle_nn::Embedding;
 use std::path::PathBuf;
 use std::collections::HashMap;
@@ -16,7 +16,21 @@ use serde::Deserialize;
 use std::env;
 
 // Reuse the model logic from the library
-use crate::models::t3_candle::T3Candle;
+use crate::models::t3_candle::{SamplingConfig, T3Candle};
+
+lazy_static::lazy_static! {
+    /// Clause splitter for synthesis chunks, compiled once rather than per request.
+    static ref SENTENCE_RE: regex::Regex = regex::Regex::new(r"(?s)[^.!?\n\r,;:]+[.!?\n\r,;:]*").unwrap();
+}
+
+/// Splits text into trimmed clauses, borrowing from the input. Single-character
+/// fragments carry no speech and are dropped.
+fn split_sentences(text: &str) -> Vec<&str> {
+    SENTENCE_RE.find_iter(text)
+        .map(|m| m.as_str().trim())
+        .filter(|s| s.len() > 1)
+        .collect()
+}
 
 struct ModelPool {
     receiver: Arc<tokio::sync::Mutex<mpsc::UnboundedReceiver<T3Candle>>>,
@@ -53,7 +67,10 @@ pub struct AudioEngine {
     start_token: i64,
     stop_token: i64,
     device: Device,
-    decoder_device: Device,
+    speaker_embeddings: Tensor,
+    speaker_features: Tensor,
+    batch_size: usize,
+    sampling: SamplingConfig,
     sink: Arc<rodio::Sink>,
 }
 
@@ -71,97 +88,194 @@ impl AudioEngine {
         };
 
         let decoder_device = Device::Cpu;
+        Self::configure_cpu_threads();
         info!("AudioEngine: Loading Engine (T3: {:?}, Decoder: {:?})", device, decoder_device);
 
         let config = crate::models::t3::Config::t3_turbo();
-        let raw_weights = candle_core::safetensors::load(artifact_dir.join("speaker_weights_q8.safetensors"), &device)?;
-        
+        // Memory-map the weights so each tensor is materialised straight from the page cache
+        // rather than through a full-file read buffer. Tensors keep their stored dtype: the
+        // loaders upcast only what they compute with, and cast_weights picks the final dtype.
+        let weights_path = artifact_dir.join("speaker_weights_q8.safetensors");
+        let safetensors = unsafe { candle_core::safetensors::MmapedSafetensors::new(&weights_path)? };
         let mut t3_weights = HashMap::new();
-        for (name, tensor) in raw_weights {
-            let dt = tensor.dtype();
-            if dt.is_float() {
-                t3_weights.insert(name, tensor.to_dtype(candle_core::DType::F32)?);
-            } else {
-                t3_weights.insert(name, tensor);
-            }
+        for (name, _) in safetensors.tensors() {
+            let tensor = safetensors.load(&name, &device)?;
+            t3_weights.insert(name, tensor);
         }
 
-        let mut models = Vec::new();
-        for i in 0..2 { // Reduced pool size for integrated mode
-            debug!("AudioEngine: Initializing model instance {}...", i);
-            models.push(T3Candle::load_from_map(&t3_weights, &config, &device)?);
+        let compute_dtype = Self::compute_dtype();
+
+        // Models decoding concurrently; each one holds its own KV caches.
+        let pool_size = env::var("AGENCY_SPEAKER_POOL")
+            .ok()
+            .and_then(|v| v.parse::<usize>().ok())
+            .filter(|&n| n > 0)
+            .unwrap_or(2);
+
+        let start_token: i64 = 6561;
+        let speech_emb = crate::models::t3_candle::load_embedding(
+            &t3_weights, "speech_emb", 6563, 1024, &device
+        )?;
+
+        // Weights are loaded, dequantized and cast once; the other pool instances are clones
+        // sharing those tensors, each with its own KV buffers.
+        let mut model = T3Candle::load_from_map(&t3_weights, &config, &device)?;
+        model.cast_weights(compute_dtype)?;
+        match model.projection_dtype() {
+            Some(dtype) => info!("AudioEngine: T3 projections in {:?}", dtype),
+            None => info!("AudioEngine: T3 projections on packed Q8_0 kernels ({:?} requested, not applied)", compute_dtype),
+        }
+        if env::var("AGENCY_SPEAKER_WARMUP").map(|v| v != "0").unwrap_or(true) {
+            let start_time = std::time::Instant::now();
+            // Clones taken below inherit the cached condition state, and kernels are compiled
+            // per device, so warming this one instance covers the whole pool
+            model.warmup(&speech_emb, start_token as u32)?;
+            info!("AudioEngine: Warmed up T3 in {}ms", start_time.elapsed().as_millis());
+        }
+        let mut models = Vec::with_capacity(pool_size);
+        for i in 1..pool_size {
+            debug!("AudioEngine: Cloning model instance {}...", i);
+            models.push(model.clone());
         }
+        models.push(model);
         let model_pool = Arc::new(ModelPool::new(models));
 
         let tokenizer = Tokenizer::from_file(artifact_dir.join("tokenizer.json"))
             .map_err(|e| anyhow::anyhow!("Tokenizer error: {}", e))?;
 
-        let speech_emb = crate::models::t3_candle::load_embedding(
-            &t3_weights, "speech_emb", 6563, 1024, &device
-        )?;
+        let decoder_model = crate::models::onnx_loader::load_model(artifact_dir.join("conditional_decoder_q8_full.onnx"))?;
+        // Voice conditioning is identical for every chunk, so it is built once and shared
+        let speaker_embeddings = Tensor::zeros((1, 192), DType::F32, &decoder_device)?;
+        let speaker_features = Tensor::zeros((1, 10, 80), DType::F32, &decoder_device)?;
 
-        let decoder_model = candle_onnx::read_file(artifact_dir.join("conditional_decoder_q8_full.onnx"))?;
+        // Sentences decoded together per T3 pass after the first one. Decode is
+        // weight-bandwidth bound, so batching amortises each weight read across the rows, but
+        // a batch is only as fast as its longest row; the default keeps one sentence per pass
+        // so every pool model stays busy and no sentence waits on its neighbours.
+        let batch_size = env::var("AGENCY_SPEAKER_BATCH")
+            .ok()
+            .and_then(|v| v.parse::<usize>().ok())
+            .filter(|&n| n > 0)
+            .unwrap_or(1);
 
         Ok(Self {
             decoder_model: Arc::new(decoder_model),
             tokenizer,
             model_pool,
             speech_emb,
-            start_token: 6561,
+            start_token,
             stop_token: 6562,
             device,
-            decoder_device,
+            speaker_embeddings,
+            speaker_features,
+            batch_size,
+            sampling: SamplingConfig::from_env(),
             sink,
         })
     }
 
+    /// Sizes the intra-op pool used by the CPU kernels (candle's gemm and the decoder both
+    /// run on the global rayon pool). By default it takes half the cores, with a floor of 4,
+    /// leaving headroom for the tokio runtime, tokenizer and audio output thread.
+    /// `AGENCY_SPEAKER_THREADS` overrides; an explicit `RAYON_NUM_THREADS` is left alone.
+    /// The environment is only read, never written: this runs on a live tokio runtime, where
+    /// `setenv` would race candle's per-op `getenv`. Sizing the global pool is enough, since
+    /// every parallel kernel executes on its threads.
+    fn configure_cpu_threads() {
+        if env::var_os("RAYON_NUM_THREADS").is_some() {
+            return;
+        }
+        let cores = std::thread::available_parallelism().map(|n| n.get()).unwrap_or(4);
+        let threads = env::var("AGENCY_SPEAKER_THREADS")
+            .ok()
+            .and_then(|v| v.parse::<usize>().ok())
+            .filter(|&n| n > 0)
+            .unwrap_or_else(|| (cores / 2).max(4).min(cores));
+        if rayon::ThreadPoolBuilder::new().num_threads(threads).build_global().is_err() {
+            debug!("AudioEngine: rayon pool already initialised, keeping its size");
+            return;
+        }
+        info!("AudioEngine: {} intra-op threads ({} cores)", threads, cores);
+    }
+
+    /// Dtype for the T3 projection weights. F32 unless `AGENCY_T3_DTYPE` (f16/bf16) opts into
+    /// half precision, which halves the weight stream on GPUs but has not been checked for
+    /// token parity against F32.
+    fn compute_dtype() -> DType {
+        match env::var("AGENCY_T3_DTYPE").unwrap_or_default().to_lowercase().as_str() {
+            "f16" => DType::F16,
+            "bf16" => DType::BF16,
+            _ => DType::F32,
+        }
+    }
+
     pub async fn synthesize(&self, text: String) -> Result<()> {
         let (audio_tx, mut audio_rx) = mpsc::unbounded_channel::<(usize, Vec<f32>)>();
         
-        let re = regex::Regex::new(r"(?s)[^.!?\n\r,;:]+[.!?\n\r,;:]*")?;
-        let sentences: Vec<String> = re.find_iter(&text) 
-            .map(|m| m.as_str().trim().to_string())
-            .filter(|s| !s.is_empty() && s.len() > 1)
-            .collect();
+        let sentences = split_sentences(&text);
 
         if sentences.is_empty() { return Ok(()); }
         info!("AudioEngine: Synthesizing {} chunks...", sentences.len());
 
-        for (idx, sentence) in sentences.into_iter().enumerate() {
+        // The first sentence always decodes alone so playback starts as early as possible
+        let mut batches = vec![(0, &sentences[..1])];
+        batches.extend(sentences[1..].chunks(self.batch_size).enumerate()
+            .map(|(i, batch)| (1 + i * self.batch_size, batch)));
+
+        for (first_idx, batch) in batches {
+            let batch: Vec<String> = batch.iter().map(|s| s.to_string()).collect();
             let audio_tx = audio_tx.clone();
             let pool = self.model_pool.clone();
             let decoder_model = self.decoder_model.clone();
             let speech_emb = self.speech_emb.clone();
             let device = self.device.clone();
-            let decoder_device = self.decoder_device.clone();
+            let speaker_embeddings = self.speaker_embeddings.clone();
+            let speaker_features = self.speaker_features.clone();
             let start_token = self.start_token;
             let stop_token = self.stop_token;
             let tokenizer = self.tokenizer.clone();
+            let sampling = self.sampling.clone();
 
             tokio::spawn(async move {
                 let mut model = pool.checkout().await;
                 let start_time = std::time::Instant::now();
                 
+                let batch_len = batch.len();
+                
                 let result = tokio::task::spawn_blocking(move || {
-                    let tokens = T3Candle::generate_tokens_internal_static(
-                        &mut model, &tokenizer, &sentence, &speech_emb, 
-                        &device, start_token, stop_token
-                    )?;
-                    
-                    let audio = Self::decode_audio_native_static(&decoder_model, &tokens, &decoder_device)?;
-                    Ok::<(Vec<f32>, T3Candle), anyhow::Error>((audio, model))
+                    let mut sent = 0;
+                    let outcome = (|| -> Result<()> {
+                        let rows = T3Candle::generate_tokens_batch_static(
+                            &mut model, &tokenizer, &batch, &speech_emb, 
+                            &device, start_token, stop_token, &sampling
+                        )?;
+                        // Each row is sent as soon as it is vocoded, so playback of the
+                        // first sentence does not wait for the rest of the batch
+                        for tokens in &rows {
+                            let audio = Self::decode_audio_native_static(
+                                &decoder_model, tokens, &speaker_embeddings, &speaker_features
+                            )?;
+                            let _ = audio_tx.send((first_idx + sent, audio));
+                            sent += 1;
+                        }
+                        Ok(())
+                    })();
+                    if let Err(e) = &outcome {
+                        error!("AudioEngine: Inference error on chunks {}..{}: {}", first_idx + sent, first_idx + batch_len, e);
+                        for idx in first_idx + sent..first_idx + batch_len {
+                            let _ = audio_tx.send((idx, Vec::new()));
+                        }
+                    }
+                    (model, outcome.is_ok())
                 }).await;
 
                 match result {
-                    Ok(Ok((audio, model))) => {
-                        let _ = audio_tx.send((idx, audio));
-                        debug!("AudioEngine: Chunk {} done in {}ms", idx, start_time.elapsed().as_millis());
+                    Ok((model, ok)) => {
+                        if ok {
+                            debug!("AudioEngine: Chunks {}..{} done in {}ms", first_idx, first_idx + batch_len, start_time.elapsed().as_millis());
+                        }
                         pool.checkin(model);
                     }
-                    Ok(Err(e)) => {
-                        error!("AudioEngine: Inference error on chunk {}: {}", idx, e);
-                        let _ = audio_tx.send((idx, Vec::new()));
-                    }
                     Err(e) => error!("AudioEngine: Task join error: {}", e),
                 }
             });
@@ -194,7 +308,8 @@ impl AudioEngine {
     fn decode_audio_native_static(
         decoder_model: &candle_onnx::onnx::ModelProto, 
         tokens: &[i64], 
-        device: &Device
+        speaker_embeddings: &Tensor,
+        speaker_features: &Tensor
     ) -> Result<Vec<f32>> {
         let mut speech_tokens: Vec<i64> = tokens.iter() 
             .cloned() 
@@ -210,8 +325,8 @@ impl AudioEngine {
         
         let mut inputs = HashMap::new();
         inputs.insert("speech_tokens".to_string(), tokens_t);
-        inputs.insert("speaker_embeddings".to_string(), Tensor::zeros((1, 192), candle_core::DType::F32, device)?);
-        inputs.insert("speaker_features".to_string(), Tensor::zeros((1, 10, 80), candle_core::DType::F32, device)?);
+        inputs.insert("speaker_embeddings".to_string(), speaker_embeddings.clone());
+        inputs.insert("speaker_features".to_string(), speaker_features.clone());
         
         let outputs = candle_onnx::simple_eval(decoder_model, inputs)?;
         let waveform = outputs.get("waveform").ok_or_else(|| anyhow::anyhow!("No waveform output"))?;
@@ -266,4 +381,24 @@ async fn say_handler(
             Json(serde_json::json!({ "status": "error", "message": e.to_string() }))
         }
     }
-}
\ No newline at end of file
+}
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_split_sentences_on_clause_punctuation() {
+        let text = "Hello, world! How are you?\nFine; thanks: bye.";
+        assert_eq!(
+            split_sentences(text),
+            vec!["Hello,", "world!", "How are you?", "Fine;", "thanks:", "bye."]
+        );
+    }
+
+    #[test]
+    fn test_split_sentences_drops_single_char_fragments() {
+        assert_eq!(split_sentences("Hello,  ,world. x"), vec!["Hello,", "world."]);
+        assert!(split_sentences("  a ").is_empty());
+        assert!(split_sentences("").is_empty());
+    }
+}